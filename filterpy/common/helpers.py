@@ -132,6 +132,11 @@ class Saver(object):
 
         v = copy.deepcopy(kf.__dict__)
 
+        # ClassProperty keeps its template and value in the instance
+        # dictionary under the property name, the value was saved above
+        for prop in self.properties:
+            v.pop(prop[0], None)
+
         if self._skip_private:
             for key in list(v.keys()):
                 if key.startswith('_'):
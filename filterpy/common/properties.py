@@ -11,8 +11,27 @@ Copyright 2020 Alexandre Felipe.
 """
 
 
+import functools
+import operator
+import sys
 import numpy as np;
 
+class _Missing:
+  '''
+    Marks a property value that was not assigned yet, None is a valid value.
+  '''
+  __slots__ = ()
+  def __reduce__(self):
+    # copies and pickles of an instance refer to the same marker
+    return '_MISSING'
+  def __repr__(self):
+    return '<missing>'
+
+_MISSING = _Missing()
+
+# The entry of a ClassProperty that was never assigned
+_EMPTY_SLOT = (None, _MISSING)
+
 class Template:
   '''
     This class provides a mechanism to set validators to class parameters as 
@@ -20,6 +39,7 @@ class Template:
     way comes from the fact that, as far as I know, python cannot set 
     descriptors per instance.
   '''
+  __slots__ = ('name',)
   def __init__(self):
     self.name = 'template' # the name of the associated property
   def __call__(self, v):
@@ -33,6 +53,7 @@ class ClassProperty:
     https://docs.python.org/3.9/howto/descriptor.html
 
   '''
+  __slots__ = ('name', 'template', '_key')
 
   # Make name argument optional and 
   # stop using it when support for python<3.6
@@ -40,6 +61,20 @@ class ClassProperty:
   def __init__(self, name):
     self.name = name
     self.template = Template()
+    self._set_keys(name)
+
+  def _set_keys(self, name):
+    # The template and the value are stored together as a tuple
+    # (template, value) in the instance dictionary under the property
+    # name itself, this is safe because a data descriptor takes precedence
+    # over the instance dictionary. Keeping the values in the instance,
+    # rather than in a mapping owned by the descriptor, lets instances be
+    # copied and pickled along with their properties. The key is interned
+    # so that the dictionary lookups can compare it by identity. The template is
+    # either None or a Template, that is always callable, as __set__ is
+    # the only place where it is assigned. The tuple is replaced on every
+    # assignment, so that copies of an instance do not share it.
+    self._key = sys.intern(name)
 
   def __set_name__(self, owner, name):
     '''
@@ -48,24 +83,39 @@ class ClassProperty:
     https://docs.python.org/3.9/reference/datamodel.html#object.__set_name__
     '''
     self.name = name
+    self._set_keys(name)
   def __get__(self, obj, objtype=None):
-    try:
-      return obj.__dict__[self.name + '#value']
-    except KeyError:
+    v = obj.__dict__.get(self._key, _EMPTY_SLOT)[1]
+    if v is _MISSING:
       raise AttributeError('Property ' + self.name + ' is not defined yet');
+    return v
   def __set__(self, obj, v):
-    if isinstance(v, Template):
-      obj.__dict__[self.name + '#template'] = v
+    d = obj.__dict__
+    template, value = d.get(self._key, _EMPTY_SLOT)
+    # Templates are assigned once per property while values are assigned
+    # at every step of a filter, an exact type comparison spares the
+    # isinstance check for the common case of an ndarray.
+    if type(v) is not np.ndarray and isinstance(v, Template):
       v.name = self.name
+      d[self._key] = (v, value)
     else:
-      template = None
-      try:
-        template = obj.__dict__[self.name + '#template']
-      except KeyError:
-        pass
-      if callable(template):
+      if template is not None:
         v = template(v)
-      obj.__dict__[self.name + '#value'] = v
+      d[self._key] = (template, v)
+
+def _scaled_identity(n, s):
+  '''
+    The identity matrix of order n multiplied by the scalar s, only the
+    diagonal is written to a new matrix of zeros. The elements off the
+    diagonal are zero even if s is nan or inf.
+  '''
+  dtype = np.result_type(s, float)
+  if not np.issubdtype(dtype, np.number):
+    raise TypeError('Expected a number, got {!r}'.format(s))
+  I = np.zeros((n, n), dtype=dtype)
+  np.fill_diagonal(I, s)
+  return I
+
 def as_matrix(shape, v, name='matrix', multiplicative=True):
   '''
     Ensures that v is a matrix of the given shape. Axes of length 1 may be 
@@ -77,22 +127,115 @@ def as_matrix(shape, v, name='matrix', multiplicative=True):
     Any matrix type may be set to the all zeros matrix of the exepcted shape
     by passing v = 0.
   '''
+  if type(v) is np.ndarray and v.shape == shape:
+    # Steady state of a filter, the value already has the right shape
+    return v
+  return _as_matrix(v, shape, name, multiplicative)
+
+def _shape_error(name, shape, m):
+  return ValueError("Expected {} to be of shape {}, value has shape {}"
+      .format(name, shape, np.shape(m)))
+
+@functools.singledispatch
+def _as_matrix(v, shape, name, multiplicative):
+  # Lists, tuples and any other array-like value
+  return _as_matrix_array(np.asarray(v), shape, name, multiplicative)
+
+@_as_matrix.register(np.ndarray)
+def _as_matrix_array(m, shape, name, multiplicative):
   M,N = shape
-  m = np.squeeze(v)
+  if (M,N) == m.shape:
+    return m
 
+  m = m.squeeze()
   if (M,N) == m.shape:
     return m
     
   if m.ndim <= 1 and (M == 1 or N == 1) and (M * N == m.size):
+    # Only axes of length 1 are added, this is a view even if m is not
+    # contiguous, and unlike setting m.shape it leaves the input untouched
     return m.reshape((M, N))
   if m.ndim == 0:
-    if m == 0:
-      return np.zeros((M, N))
-    elif multiplicative and M == N:
-      return m * np.eye(M, N)
+    return _scalar_matrix(m, shape, name, multiplicative)
   # Any of the above cases matched
-  raise ValueError("Expected {} to be of shape {}, value has shape {}"
-      .format(name, shape, m.shape))
+  raise _shape_error(name, shape, m)
+
+@_as_matrix.register(int)
+@_as_matrix.register(float)
+def _as_matrix_scalar(v, shape, name, multiplicative):
+  return _scalar_matrix(v, shape, name, multiplicative)
+
+def _scalar_matrix(s, shape, name, multiplicative):
+  '''
+    The matrix of the given shape represented by the scalar s, either a
+    Python scalar or an array with no dimensions. A single element matrix
+    holds s itself, keeping its type, otherwise s may stand for the zero
+    matrix or, if multiplicative, for a scaled identity.
+  '''
+  M,N = shape
+  if M * N == 1:
+    return np.asarray(s).reshape((M, N))
+  if s == 0:
+    return np.zeros((M, N))
+  elif multiplicative and M == N:
+    return _scaled_identity(M, s)
+  raise _shape_error(name, shape, s)
+
+def _dispatch_table(shape, multiplicative):
+  '''
+    Handlers for the most common kinds of input, keyed by type and
+    number of dimensions. A handler is called as handler(v, name) and
+    returns None when it cannot convert the value, which is then left to
+    as_matrix. ndarrays of the expected shape are matched by the validator
+    before the table is used.
+  '''
+  M, N = shape
+  table = {}
+  if M == 1 or N == 1:
+    def vector(v, name):
+      if v.size == M * N:
+        # a view, see _as_matrix_array
+        return v.reshape(shape)
+    table[(np.ndarray, 1)] = vector
+  def scalar(v, name):
+    # the same rules as as_matrix, a 1x1 matrix keeps the type of v
+    return _scalar_matrix(v, shape, name, multiplicative)
+  for t in (int, float, np.float64):
+    table[(t, 0)] = scalar
+  return table
+
+_VALIDATOR_SOURCE = '''
+def validate(v, name):
+  if type(v) is ndarray and v.shape == {shape!r}:
+    return v
+  handler = dispatch.get((type(v), getattr(v, 'ndim', 0)))
+  if handler is not None:
+    m = handler(v, name)
+    if m is not None:
+      return m
+  return as_matrix_slow(v, {shape!r}, name, {multiplicative!r})
+'''
+
+@functools.lru_cache(maxsize=None)
+def _validator(shape, multiplicative):
+  '''
+    Compiles a function validate(v, name) equivalent to 
+    as_matrix(shape, v, name, multiplicative) with the shape written
+    as a constant in its code. The function is shared by all the
+    templates with the same parameters.
+  '''
+  M, N = shape
+  source = _VALIDATOR_SOURCE.format(
+      shape=(operator.index(M), operator.index(N)),
+      multiplicative=bool(multiplicative))
+  namespace = {
+    'ndarray': np.ndarray,
+    # the exact match was already checked, skip the as_matrix fast path
+    'as_matrix_slow': _as_matrix,
+    'dispatch': _dispatch_table(shape, multiplicative)
+  }
+  exec(compile(source, '<validator {}x{}>'.format(M, N), 'exec'), namespace)
+  return namespace['validate']
 
 class MatrixTemplate(Template):
   '''
@@ -102,18 +245,75 @@ class MatrixTemplate(Template):
     A square matrix being multiplicative also makes that a scalar
     is converted to a scaled identity matrix, that will lead to the 
     same result when used in a matrix multiplication.
+
+    If fast_mode is set, after trust_after consecutive assignments of
+    arrays with exactly the expected shape the values are no longer
+    validated nor converted, any value is then stored as given, including
+    lists and scalars. This is meant for inner loops where the caller is
+    known to produce valid matrices. Fast mode is enabled per template,
+    with the constructor arguments or trust(), and disabled with
+    validate_always().
   '''
-  def __init__(self, m, n, multiplicative=True):
+  __slots__ = ('shape', 'multiplicative', 'fast_mode', 'trust_after',
+               '_matches', '_validate')
+  def __init__(self, m, n, multiplicative=True, fast_mode=False,
+               trust_after=16):
     self.shape = (m, n)
     self.multiplicative = multiplicative
+    self.fast_mode = fast_mode
+    self.trust_after = trust_after
+    self._matches = 0
+    self._validate = _validator(self.shape, multiplicative)
+  def __getstate__(self):
+    # The compiled validator cannot be pickled, it is left out and
+    # taken again from the cache when the template is loaded.
+    state = dict(getattr(self, '__dict__', {}))
+    for k in ('name', 'shape', 'multiplicative', 'fast_mode', 'trust_after',
+              '_matches'):
+      if hasattr(self, k):
+        state[k] = getattr(self, k)
+    return state
+  def __setstate__(self, state):
+    for k, v in state.items():
+      setattr(self, k, v)
+    self._validate = _validator(self.shape, self.multiplicative)
+  def trust(self, trust_after=None):
+    '''
+      Enable fast_mode for this template, optionally changing the number
+      of matching assignments required before validation stops.
+    '''
+    self.fast_mode = True
+    if trust_after is not None:
+      self.trust_after = trust_after
+    self._matches = 0
+    return self
+  def validate_always(self):
+    '''
+      Validate every value assigned through this template, disabling
+      fast_mode.
+    '''
+    self.fast_mode = False
+    self._matches = 0
+    return self
   def __call__(self, v):
-    return as_matrix(self.shape, v, multiplicative=self.multiplicative, name=self.name)
+    if not self.fast_mode:
+      return self._validate(v, self.name)
+    n = self._matches
+    if n >= self.trust_after:
+      return v
+    m = self._validate(v, self.name)
+    if type(v) is np.ndarray and v.shape == self.shape:
+      self._matches = n + 1
+    else:
+      self._matches = 0
+    return m
 
 class DecoratedMatrixFunction:
   '''
     A template that makes sure that a function will return a matrix
     of the given shape.
   '''
+  __slots__ = ('shape', 'f', 'name', 'multiplicative', 'resultName')
   def __init__(self, shape, f, name=None, multiplicative=True):
     if not callable(f):
       raise ValueError('f must be callable')
@@ -136,6 +336,7 @@ class DecoratedMatrixFunction:
           )
 
 class MatrixFunctionTemplate(Template):
+  __slots__ = ('shape', 'multiplicative')
   def __init__(self, m, n, multiplicative=True):
     self.shape = (m,n)
     self.multiplicative = multiplicative
@@ -155,6 +356,7 @@ class MatrixFunctionTemplate(Template):
       return DecoratedMatrixFunction(self.shape, f, self.name, self.multiplicative)
 
 class MatrixFunction:
+  __slots__ = ('shape', 'name', 'multiplicative')
   def __init__(self, m, n, multiplicative=True, name=None):
     self.shape = (m,n)
     self.name = name
@@ -168,6 +370,6 @@ class MatrixFunction:
           name = None
       except:
         pass
-    return DecoratedMatrixFunction(self.shape, f, self.multiplicative, name)
+    return DecoratedMatrixFunction(self.shape, f, name, self.multiplicative)
       
 
@@ -15,6 +15,7 @@ for more information.
 """
 
 from filterpy.common import kinematic_kf, Saver, inv_diagonal, outer_product_sum
+from filterpy.common.properties import ClassProperty, MatrixTemplate
 
 import numpy as np
 from filterpy.kalman import (MerweScaledSigmaPoints, UnscentedKalmanFilter,
@@ -198,6 +199,35 @@ def test_save_properties():
     assert f.a == 4
 
 
+def test_save_class_properties():
+    class Foo(object):
+        x = ClassProperty('x')
+        P = ClassProperty('P')
+
+        def __init__(self):
+            self.x = MatrixTemplate(2, 1)
+            self.P = MatrixTemplate(2, 2)
+            self.x = 0
+            self.P = 1.
+            self.k = 0
+
+    f = Foo()
+    s = Saver(f)
+    s.save()
+    f.x = [1., 2.]
+    f.k = 1
+    s.save()
+
+    # each property is recorded once per save and holds the value only
+    assert sorted(s.keys) == ['P', 'k', 'x']
+    assert len(s.x) == 2
+    assert len(s.P) == 2
+    assert np.array_equal(s.x[0], np.zeros((2, 1)))
+    assert np.array_equal(s.x[1], [[1.], [2.]])
+    assert np.array_equal(s.P[1], np.eye(2))
+    assert s.k == [0, 1]
+
+
 def test_outer_product():
     sigmas = np.random.randn(1000000, 2)
     x = np.random.randn(2)
@@ -1,4 +1,4 @@
-import sys, os, unittest;
+import copy, pickle, sys, os, unittest;
 import numpy as np;
 
 # Since tests are meant to be used in development
@@ -8,6 +8,10 @@ if __name__ == '__main__':
 
 from filterpy.common import properties;
 
+# Module level so that it can be pickled
+def transition(x):
+  return x
+
 class PropertyAccess(unittest.TestCase):
   class Class:
     prop1 = properties.ClassProperty('prop1')
@@ -32,6 +36,64 @@ class PropertyAccess(unittest.TestCase):
     self.assertEqual(c.prop1, 'x')
     self.assertEqual(d.prop1, 'y')
 
+  def test_storage(self):
+    c = PropertyAccess.Class()
+    c.prop1 = properties.Template()
+    c.prop1 = 'x'
+    # template and value are kept in a single entry of the instance
+    # dictionary under the property name
+    self.assertEqual(list(vars(c)), ['prop1'])
+
+  def test_copy(self):
+    c = PropertyAccess.Class()
+    c.prop1 = properties.Template()
+    d = copy.deepcopy(c)
+    with self.assertRaises(AttributeError):
+      x = d.prop1
+    d.prop1 = 'x'
+    self.assertEqual(d.prop1, 'x')
+    with self.assertRaises(AttributeError):
+      x = c.prop1
+
+  def test_shallow_copy(self):
+    c = PropertyAccess.Class()
+    c.prop1 = properties.MatrixTemplate(2,2)
+    c.prop1 = np.eye(2)
+    d = copy.copy(c)
+    d.prop1 = 0
+    self.assertTrue(np.allclose(c.prop1, np.eye(2)))
+    self.assertTrue(np.allclose(d.prop1, 0))
+    d.prop1 = properties.MatrixTemplate(1,4)
+    c.prop1 = 3
+    self.assertTrue(np.allclose(c.prop1, 3 * np.eye(2)))
+
+  def test_copy_values(self):
+    c = PropertyAccess.Class()
+    c.prop1 = 'x'
+    for d in [copy.deepcopy(c), pickle.loads(pickle.dumps(c))]:
+      self.assertEqual(d.prop1, 'x')
+      d.prop1 = 'y'
+      self.assertEqual(c.prop1, 'x')
+
+  def test_copy_templates(self):
+    c = PropertyAccess.Class()
+    c.prop1 = properties.MatrixTemplate(2,2)
+    c.prop1 = np.eye(2)
+    c.prop2 = properties.MatrixFunctionTemplate(2,2)
+    c.prop2 = transition
+    for d in [copy.deepcopy(c), pickle.loads(pickle.dumps(c))]:
+      self.assertTrue(np.array_equal(d.prop1, np.eye(2)))
+      self.assertIsInstance(d.prop2, properties.DecoratedMatrixFunction)
+      # validation still works after loading
+      d.prop1 = 3
+      self.assertTrue(np.array_equal(d.prop1, 3 * np.eye(2)))
+      with self.assertRaisesRegex(ValueError, 'Expected prop1 '):
+        d.prop1 = np.eye(3)
+      self.assertTrue(np.array_equal(d.prop2(2), 2 * np.eye(2)))
+      with self.assertRaisesRegex(ValueError, 'return value of prop2'):
+        d.prop2(np.eye(3))
+      self.assertTrue(np.array_equal(c.prop1, np.eye(2)))
+
 class PropertyValidation(unittest.TestCase):
   n = properties.ClassProperty('n')
   def test_validation(self):
@@ -66,6 +128,20 @@ class Test_1x1(unittest.TestCase):
     self.A = 1234
     self.assertEqual(self.A.shape, (1,1))
     self.assertEqual(self.A[0][0], 1234)
+  def test_assign_0D_keeps_type(self):
+    self.A = properties.MatrixTemplate(1,1)
+    for v in [5, np.int64(5), True, 2.5]:
+      self.A = v
+      self.assertEqual(self.A.dtype, np.asarray(v).dtype)
+  def test_assign_0D_non_multiplicative(self):
+    self.A = properties.MatrixTemplate(1,1,multiplicative=False)
+    for v in [5, 2.5, np.int64(5), np.array(2.5)]:
+      self.A = v
+      self.assertEqual(self.A.shape, (1,1))
+      self.assertEqual(self.A[0][0], v)
+    z = properties.as_matrix((1,1), 2.5, 'z', multiplicative=False)
+    self.assertEqual(z.shape, (1,1))
+    self.assertEqual(z[0][0], 2.5)
   def test_assign_1D(self):
     self.A = properties.MatrixTemplate(1,1)
     # vector (1D) matrx
@@ -101,6 +177,15 @@ class TestVector(unittest.TestCase):
             self.A = y
             self.assertEqual(self.A.shape, shape);
   
+  def test_vector_is_a_view(self):
+    for shape in [(1,4), (4,1)]:
+      self.A = properties.MatrixTemplate(*shape)
+      for x in [np.arange(4.), np.arange(8.)[::2]]:
+        self.A = x
+        self.assertEqual(self.A.shape, shape)
+        self.assertEqual(x.shape, (4,))
+        self.assertTrue(np.shares_memory(self.A, x))
+
   def test_invalid_1D(self):
     for n in range(2, 5):
       for x in [list(range(1, n+2)), list(range(1, n))]:
@@ -149,12 +234,49 @@ class TestMatrix(unittest.TestCase):
     
     self.A = np.zeros((m,n))
 
+  def test_matching_array_is_not_copied(self):
+    self.A = properties.MatrixTemplate(3,5)
+    a = np.zeros((3,5))
+    self.A = a
+    self.assertIs(self.A, a)
+
+  def test_templates_with_same_parameters(self):
+    class Filter:
+      x = properties.ClassProperty('x')
+      z = properties.ClassProperty('z')
+    f = Filter()
+    f.x = properties.MatrixTemplate(3,1)
+    f.z = properties.MatrixTemplate(3,1)
+    # the compiled validator is shared but each template reports
+    # errors with the name of its own property
+    self.assertIs(vars(f)['x'][0]._validate, vars(f)['z'][0]._validate)
+    with self.assertRaisesRegex(ValueError, 'Expected x '):
+      f.x = np.zeros(4)
+    with self.assertRaisesRegex(ValueError, 'Expected z '):
+      f.z = np.zeros(4)
+
   def test_multiplicative(self):
     self.A = properties.MatrixTemplate(4,4,multiplicative=True)
     self.A = 4
     self.assertTrue(np.allclose(self.A, 4 * np.eye(4)))
     with self.assertRaises(ValueError):
       self.A = np.ones(4)
+
+    # the scaled identity must be a new matrix each time
+    self.A[0,0] = 1
+    self.A = 2
+    self.assertTrue(np.allclose(self.A, 2 * np.eye(4)))
+    
+    # only numbers may stand for a scaled identity
+    for s in [None, 'abc', np.array(None)]:
+      with self.assertRaises(TypeError):
+        self.A = s
+
+    # non finite scalars only fill the diagonal
+    for s in [np.nan, np.inf, -np.inf]:
+      self.A = s
+      self.assertTrue(np.array_equal(np.diag(self.A), [s] * 4, equal_nan=True))
+      self.assertTrue(np.all(self.A[~np.eye(4, dtype=bool)] == 0))
     
     self.A = properties.MatrixTemplate(4,4,multiplicative=False)
     with self.assertRaises(ValueError):
@@ -162,6 +284,56 @@ class TestMatrix(unittest.TestCase):
     with self.assertRaises(ValueError):
       self.A = np.ones(4)
 
+class TestFastMode(unittest.TestCase):
+  A = properties.ClassProperty('A')
+
+  def test_trusted_after_matches(self):
+    self.A = properties.MatrixTemplate(2,2,fast_mode=True,trust_after=3)
+    for i in range(3):
+      self.A = np.eye(2)
+    # validation is skipped once the template trusts the caller
+    self.A = np.eye(3)
+    self.assertEqual(self.A.shape, (3,3))
+    # and values are no longer converted
+    self.A = [1, 2]
+    self.assertEqual(self.A, [1, 2])
+
+  def test_mismatch_resets_trust(self):
+    self.A = properties.MatrixTemplate(2,2).trust(3)
+    for i in range(2):
+      self.A = np.eye(2)
+    self.A = 1
+    for i in range(2):
+      self.A = np.eye(2)
+    with self.assertRaises(ValueError):
+      self.A = np.eye(3)
+
+  def test_per_template(self):
+    class Filter:
+      P = properties.ClassProperty('P')
+      Q = properties.ClassProperty('Q')
+    f = Filter()
+    f.P = properties.MatrixTemplate(2,2)
+    f.Q = properties.MatrixTemplate(2,2)
+    f.P = np.eye(2)
+    f.Q = np.eye(2)
+    t = vars(f)['P'][0]
+    t.fast_mode = True
+    t.trust_after = 1
+    f.P = np.eye(2)
+    f.Q = np.eye(2)
+    f.P = np.eye(3)
+    self.assertEqual(f.P.shape, (3,3))
+    with self.assertRaises(ValueError):
+      f.Q = np.eye(3)
+
+  def test_validate_always(self):
+    self.A = properties.MatrixTemplate(2,2).trust(3).validate_always()
+    for i in range(5):
+      self.A = np.eye(2)
+    with self.assertRaises(ValueError):
+      self.A = np.eye(3)
+
 class TestMatrixFunctionProperty(unittest.TestCase):
   F = properties.ClassProperty('F')
 
@@ -177,6 +349,52 @@ class TestMatrixFunctionProperty(unittest.TestCase):
       with self.assertRaises(ValueError):
         f(shape[::-1]) # Tell F to return a matrix with wrog shape
 
+  def test_decorated_function_arguments(self):
+    shape = (2,2)
+    @properties.MatrixFunction(*shape)
+    def f(x):
+      return x
+    @properties.MatrixFunction(*shape)
+    def g(x, dt):
+      return x * dt
+    self.assertIs(type(f), properties.DecoratedMatrixFunction)
+    self.assertIs(type(g), properties.DecoratedMatrixFunction)
+    self.assertTrue(np.allclose(f(np.ones(shape)), np.ones(shape)))
+    self.assertTrue(np.allclose(g(np.ones(shape), dt=2), 2*np.ones(shape)))
+
+  def test_matrix_function_parameters(self):
+    def identity(x):
+      return x
+    f = properties.MatrixFunction(3,3)(identity)
+    # multiplicative by default, a scalar stands for a scaled identity
+    self.assertTrue(np.allclose(f(2), 2 * np.eye(3)))
+    f = properties.MatrixFunction(3,3,multiplicative=False)(identity)
+    with self.assertRaises(ValueError):
+      f(2)
+    f = properties.MatrixFunction(3,3,name='F')(identity)
+    with self.assertRaisesRegex(ValueError, 'Expected return value of F '):
+      f(np.eye(2))
+
+  def test_decorated_function_subclass(self):
+    class Doubled(properties.DecoratedMatrixFunction):
+      __slots__ = ()
+      def __call__(self, *args, **kwargs):
+        return 2 * super().__call__(*args, **kwargs)
+    def f(x):
+      return np.ones(x)
+    self.F = properties.MatrixFunctionTemplate(3,2)
+    self.F = Doubled((3,2), f)
+    self.assertTrue(np.allclose(self.F((3,2)), 2 * np.ones((3,2))))
+    self.assertTrue(np.allclose(copy.deepcopy(self.F)((3,2)), self.F((3,2))))
+
+  def test_decorated_function_keyword_argument(self):
+    @properties.MatrixFunction(2,2)
+    def F(state):
+      return state
+    self.assertTrue(np.allclose(F(state=np.eye(2)), np.eye(2)))
+    with self.assertRaises(TypeError):
+      F(x=np.eye(2))
+
   def test_decorated_function_assignment(self):
     shape = (3,7)
     @properties.MatrixFunction(*shape)
@@ -20,6 +20,8 @@ if __name__ == '__main__':
     import sys, os;
     sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../../../'))
 
+import pickle
+import pytest
 import numpy.random as random
 from numpy.random import randn
 import numpy as np
@@ -538,6 +540,32 @@ def test_functions():
     assert x[0] == 3 and x[1] == 1
 
 
+def test_pickle():
+    kf = KalmanFilter(dim_x=2, dim_z=1)
+    kf.x = [1., 2.]
+    kf.F = np.array([[1., 1.], [0., 1.]])
+    kf.H = np.array([[1., 0.]])
+    kf.P = 3.
+
+    kf2 = pickle.loads(pickle.dumps(kf))
+    assert np.array_equal(kf2.x, kf.x)
+    assert np.array_equal(kf2.F, kf.F)
+    assert np.array_equal(kf2.P, kf.P)
+
+    kf.predict()
+    kf2.predict()
+    kf.update(3.)
+    kf2.update(3.)
+    assert np.allclose(kf2.x, kf.x)
+    assert np.allclose(kf2.P, kf.P)
+
+    # the templates are still validating after loading
+    kf2.Q = 2.
+    assert np.array_equal(kf2.Q, 2. * np.eye(2))
+    with pytest.raises(ValueError):
+        kf2.F = np.eye(3)
+
+
 def test_z_checks():
     kf = KalmanFilter(dim_x=3, dim_z=1)
     kf.update(3.)